@@ -1,91 +1,170 @@
 
 import streamlit as st
+import atexit
+import csv
+import logging
 import time
-import pandas as pd
 import random
 import uuid
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-def save_to_google_sheets(df, sheet_name="Responses"):
+MASTER_FILE = "all_responses.csv"
+STIMULI_FILE = "stimuli.json"
+IMAGE_URL = "app/static/images"  # served by Streamlit static file serving
+COLUMNS = ("participant_id", "group", "stimulus_id", "text", "truth", "photo",
+           "show_photo", "answer", "response_text", "response_time")
+
+# Static page text
+_INSTRUCTIONS_MD = """
+Welcome! This is a trivia quiz. You will be presented with a series of factual statements — some of them are true, some are false.
+
+Your task is to decide whether each statement is **True** or **False**. 
+
+Additionally:
+"""
+_INSTRUCTIONS_MD_EXPLAIN = "- Provide a **brief explanation** of why you think the statement is true or false."
+_INSTRUCTIONS_MD_EMOTION = "- Share **how the statement makes you feel** — your emotional response."
+_INSTRUCTIONS_MD_OUTRO = "Please answer as accurately and thoughtfully as you can. The quiz will begin once you click the button below."
+
+_DEBRIEF_MD = """
+Thank you for completing this short trivia survey!
+
+This study is part of a research project investigating how visual cues (like unrelated photos) and different kinds of reasoning (explanation vs. emotion) affect people’s perception of truth.
+
+Some of the statements you saw were factually accurate, while others were not. And some were accompanied by images that were not directly related to the content.
+
+By analyzing how people respond under different conditions, we hope to better understand how misinformation spreads online — especially when it's paired with persuasive visuals.
+
+Your responses have been recorded anonymously and will help support research in cognitive psychology and digital media literacy.
+
+If you have any questions, feel free to reach out to the research team at **aw3088@columbia.edu**. Thank you again!
+"""
+
+def append_to_master(row):
+    write_header = not os.path.exists(MASTER_FILE)
+    with open(MASTER_FILE, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, lineterminator="\n")
+        if write_header:
+            writer.writeheader()
+        writer.writerow(row)
+
+@st.cache_resource
+def get_worksheet(sheet_name="Responses"):
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     creds_dict = st.secrets["GSPREAD_KEY"]  # No json.loads() here
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     client = gspread.authorize(creds)
-    sheet = client.open("Trivia_Responses").worksheet(sheet_name)
-    for _, row in df.iterrows():
-        sheet.append_row(row.astype(str).tolist())
-
-with open("stimuli.json", "r") as f:
-    full_stimuli = json.load(f)
-
-true_pool = [s for s in full_stimuli if s["truth"]]
-false_pool = [s for s in full_stimuli if not s["truth"]]
-
-def create_balanced_stimuli(n_true=8, n_false=8, n_photo_each=4):
-    sampled_true = random.sample(true_pool, n_true)
-    sampled_false = random.sample(false_pool, n_false)
-
-    # Combine and shuffle first
-    combined = sampled_true + sampled_false
-    random.shuffle(combined)
-
-    # Select items with valid photos
-    with_photo_candidates = [s for s in combined if s.get("photo", "").endswith(".png")]
-
-    # Randomly pick 8 total to show photo (4 from true pool, 4 from false)
-    photo_ids = set()
-    true_count = 0
-    false_count = 0
-    random.shuffle(with_photo_candidates)
-    for s in with_photo_candidates:
-        if s["truth"] and true_count < n_photo_each:
-            photo_ids.add(s["id"])
-            true_count += 1
-        elif not s["truth"] and false_count < n_photo_each:
-            photo_ids.add(s["id"])
-            false_count += 1
-        if true_count == n_photo_each and false_count == n_photo_each:
-            break
-
-    # Assign show_photo flag
-    for s in combined:
-        s["show_photo"] = s["id"] in photo_ids
+    return client.open("Trivia_Responses").worksheet(sheet_name)
+
+@st.cache_resource
+def get_upload_pool():
+    # One worker keeps appends ordered; pending writes finish on shutdown
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gsheets")
+    atexit.register(pool.shutdown, wait=True)
+    return pool
+
+# 429/503 mean the request was turned away. A 500/502/504 may already have
+# written the rows, and append_rows is not idempotent, so those are not retried
+_RETRY_STATUS = (429, 503)
+
+def _append_rows(sheet, values, attempts=5):
+    # Runs on the upload worker, so backing off never blocks the page
+    for attempt in range(attempts):
+        try:
+            sheet.append_rows(values, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+            return
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code in _RETRY_STATUS and attempt < attempts - 1:
+                time.sleep(0.5 * 2 ** attempt + random.random() * 0.1)
+                continue
+            logging.exception("Google Sheets append failed")
+            return
+        except Exception:
+            logging.exception("Google Sheets append failed")
+            return
+
+def save_to_google_sheets(responses, sheet_name="Responses"):
+    sheet = get_worksheet(sheet_name)
+    values = [[str(v) for v in row] for row in zip(*(responses[c] for c in COLUMNS))]
+    get_upload_pool().submit(_append_rows, sheet, values)
+
+# Keyed on the file's mtime so an edited stimuli.json invalidates both caches
+@st.cache_data(max_entries=1)
+def load_stimuli(mtime_ns):
+    with open(STIMULI_FILE, "rb") as f:
+        return json_loads(f.read())
+
+@st.cache_data(max_entries=1)
+def split_pools(mtime_ns):
+    true_pool, false_pool = [], []
+    for s in load_stimuli(mtime_ns):
+        (true_pool if s["truth"] else false_pool).append(s)
+    return tuple(true_pool), tuple(false_pool)
+
+def create_balanced_stimuli(n_true=8, n_false=8, n_photo_each=4, rng=random):
+    true_pool, false_pool = split_pools(os.stat(STIMULI_FILE).st_mtime_ns)
+    sampled_true = rng.sample(true_pool, n_true)
+    sampled_false = rng.sample(false_pool, n_false)
+
+    # Combine (as copies, so the cached pools are never mutated) and shuffle first
+    combined = [{**s, "show_photo": False} for s in sampled_true + sampled_false]
+    rng.shuffle(combined)
+
+    # Randomly pick 8 total to show photo (4 from true pool, 4 from false) in a
+    # single pass over an independently shuffled order, so photos aren't tied to
+    # display position
+    photo_counts = {True: 0, False: 0}
+    for s in rng.sample(combined, len(combined)):
+        s["show_photo"] = (s.get("photo", "").endswith(".png")
+                           and photo_counts[s["truth"]] < n_photo_each)
+        photo_counts[s["truth"]] += s["show_photo"]
 
     return combined
 
+def subset_for(participant_id):
+    # Seeded by participant id, so a participant's subset is reproducible
+    return create_balanced_stimuli(rng=random.Random(participant_id))
+
 if "participant_id" not in st.session_state:
     st.session_state.participant_id = str(uuid.uuid4())
 
 if "group" not in st.session_state:
     st.session_state.group = random.choice(["Explain", "Emotion"])
 
-if "stimuli_subset" not in st.session_state:
-    st.session_state.stimuli_subset = create_balanced_stimuli()
+done = st.session_state.get("done", False)
 
-if "responses" not in st.session_state:
-    st.session_state.responses = []
+if "stimuli_subset" not in st.session_state and not done:
+    st.session_state.stimuli_subset = subset_for(st.session_state.participant_id)
+
+if "responses" not in st.session_state and not done:
+    st.session_state.responses = {c: [] for c in COLUMNS}  # column -> values
 
 if "current_index" not in st.session_state:
     st.session_state.current_index = 0
 
 st.title("Trivia!")
+if done:
+    # Already finished and uploaded: only show the debriefing again
+    st.markdown("### Debriefing")
+    st.markdown(_DEBRIEF_MD)
+    st.stop()
+
 if st.session_state.current_index == 0 and not st.session_state.get("instructions_shown", False):
     st.markdown("### Instructions")
-    st.markdown("""
-    Welcome! This is a trivia quiz. You will be presented with a series of factual statements — some of them are true, some are false.
-
-    Your task is to decide whether each statement is **True** or **False**. 
-
-    Additionally:
-    """)
+    st.markdown(_INSTRUCTIONS_MD)
     if st.session_state.group == "Explain":
-        st.markdown("- Provide a **brief explanation** of why you think the statement is true or false.")
+        st.markdown(_INSTRUCTIONS_MD_EXPLAIN)
     else:
-        st.markdown("- Share **how the statement makes you feel** — your emotional response.")
-    st.markdown("Please answer as accurately and thoughtfully as you can. The quiz will begin once you click the button below.")
+        st.markdown(_INSTRUCTIONS_MD_EMOTION)
+    st.markdown(_INSTRUCTIONS_MD_OUTRO)
     if st.button("Start Quiz"):
         st.session_state.instructions_shown = True
         st.rerun()
@@ -99,7 +178,7 @@ if current_idx < len(stimuli):
     st.subheader(f"Statement {current_idx + 1} of {len(stimuli)}")
     st.write(stim["text"])
 
-    image_path = os.path.join("images", stim["photo"]) if stim["photo"] else None
+    image_path = os.path.join("static", "images", stim["photo"]) if stim["photo"] else None
     
     # # 🔍 Debugging output
     # st.markdown("**🛠️ DEBUG INFO**")
@@ -109,24 +188,30 @@ if current_idx < len(stimuli):
     # st.write("Image path exists?", os.path.exists(image_path) if image_path else "None")
     
     if stim["show_photo"] and image_path and os.path.exists(image_path):
-        with open(image_path, "rb") as img_file:
-            st.image(img_file.read(), width=300)
+        st.markdown(f'<img src="{IMAGE_URL}/{stim["photo"]}" width="300">', unsafe_allow_html=True)
 
     if "start_time" not in st.session_state:
-        st.session_state.start_time = time.time()
-
-    answer = st.radio("Is this statement true or false?", ["-- Select an answer --", "True", "False"], key=f"radio_{current_idx}")
-    response_text = st.text_area(
-        "Explain your answer:" if st.session_state.group == "Explain" else "How does this statement make you feel:",
-        key=f"text_{current_idx}"
-    )
-
-    if st.button("Submit and Continue"):
-        if answer == "-- Select an answer --" or response_text.strip() == "":
+        st.session_state.start_time = time.monotonic()
+
+    with st.form(f"trial_{current_idx}"):
+        answer = st.radio(
+            "Is this statement true or false?",
+            [None, True, False],
+            format_func=lambda v: "-- Select an answer --" if v is None else str(v),
+            key=f"radio_{current_idx}"
+        )
+        response_text = st.text_area(
+            "Explain your answer:" if st.session_state.group == "Explain" else "How does this statement make you feel:",
+            key=f"text_{current_idx}"
+        )
+        submitted = st.form_submit_button("Submit and Continue")
+
+    if submitted:
+        if answer is None or response_text.strip() == "":
             st.warning("Please complete both parts before continuing.")
         else:
-            rt = round(time.time() - st.session_state.start_time, 2)
-            st.session_state.responses.append({
+            rt = round(time.monotonic() - st.session_state.start_time, 2)
+            row = {
                 "participant_id": st.session_state.participant_id,
                 "group": st.session_state.group,
                 "stimulus_id": stim["id"],
@@ -137,30 +222,20 @@ if current_idx < len(stimuli):
                 "answer": answer,
                 "response_text": response_text,
                 "response_time": rt
-            })
+            }
+            for k, v in row.items():
+                st.session_state.responses[k].append(v)
+            append_to_master(row)
             st.session_state.current_index += 1
             st.rerun()
 else:
     st.balloons()
     st.success("Thank you for participating! Your responses have been saved.")
-    df = pd.DataFrame(st.session_state.responses)
-    master_file = "all_responses.csv"
-    if os.path.exists(master_file):
-        existing = pd.read_csv(master_file)
-        df = pd.concat([existing, df], ignore_index=True)
-    df.to_csv(master_file, index=False)
-    save_to_google_sheets(df)
+    save_to_google_sheets(st.session_state.responses)  # already appended to MASTER_FILE per trial
     st.markdown("### Debriefing")
-    st.markdown("""
-    Thank you for completing this short trivia survey!
-
-    This study is part of a research project investigating how visual cues (like unrelated photos) and different kinds of reasoning (explanation vs. emotion) affect people’s perception of truth.
-
-    Some of the statements you saw were factually accurate, while others were not. And some were accompanied by images that were not directly related to the content.
-
-    By analyzing how people respond under different conditions, we hope to better understand how misinformation spreads online — especially when it's paired with persuasive visuals.
-
-    Your responses have been recorded anonymously and will help support research in cognitive psychology and digital media literacy.
+    st.markdown(_DEBRIEF_MD)
 
-    If you have any questions, feel free to reach out to the research team at **aw3088@columbia.edu**. Thank you again!
-    """)
+    # Everything is persisted: free the per-session data, keep a completion flag
+    for key in ("stimuli_subset", "responses", "start_time"):
+        st.session_state.pop(key, None)
+    st.session_state.done = True
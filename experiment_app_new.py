@@ -1,66 +1,139 @@
 from __future__ import annotations
-import json, random, sys, time, uuid, platform
+import atexit, csv, json, logging, random, sys, time, uuid, platform
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
-import pandas as pd
 import streamlit as st
+try:
+    from orjson import loads as json_loads   # faster parser when installed
+except ImportError:
+    json_loads = json.loads
 
 # ────────────────────────────── paths & constants
 BASE      = Path(__file__).parent
 STIMULI   = BASE / "stimuli.json"
-IMG_DIR   = BASE / "images"
+IMG_DIR   = BASE / "static" / "images"
+IMG_URL   = "app/static/images"              # browser-cached static route
 LOG_DIR   = BASE / "logs"; LOG_DIR.mkdir(exist_ok=True)
 CSV_FILE  = LOG_DIR / "responses.csv"
 
 N_TRUE, N_FALSE, N_PHOTO_EACH = 8, 8, 4
+COLUMNS = ("timestamp", "participant_id", "variant", "prompt_group", "stimulus_id",
+           "truth", "answer", "correct", "response_text", "show_photo", "rt",
+           "python", "platform", "streamlit")
+
+# environment info logged with every response
+_PY, _PLATFORM, _ST = sys.version.split()[0], platform.platform(), st.__version__
+
+# static debriefing text
+_DEBRIEF_MD = """
+Thank you for completing this short trivia survey!
+
+This study investigates how visual cues (unrelated photos) and reasoning style
+(**explanation** vs. **emotion**) influence people’s perception of truth.
+
+Your responses are recorded **anonymously** and will support research in
+cognitive psychology and digital‑media literacy.
+
+Questions? Email **aw3088@columbia.edu**.
+"""
 
 # optional secrets
 GSHEET_KEY = st.secrets.get("GSPREAD_KEY")  # entire service‑account JSON as TOML table
 GA_ID      = st.secrets.get("GA_ID", {}).get("value")  # GA_ID.value in secrets.toml
 
+# ╭────────────────────────── CSV log helper ────────────────────────────────╮
+def append_csv(row: dict) -> None:
+    header = not CSV_FILE.exists()
+    with CSV_FILE.open("a", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=COLUMNS, lineterminator="\n")
+        if header: w.writeheader()
+        w.writerow(row)
+
 # ╭────────────────────────── Google Sheets helper ──────────────────────────╮
 if GSHEET_KEY:
     import gspread
     from oauth2client.service_account import ServiceAccountCredentials
     _SCOPE = ["https://spreadsheets.google.com/feeds",
               "https://www.googleapis.com/auth/drive"]
-    _CREDS = ServiceAccountCredentials.from_json_keyfile_dict(GSHEET_KEY, _SCOPE)
-    _SHEET = gspread.authorize(_CREDS)\
-                    .open("Trivia_Responses")\
-                    .worksheet("Responses")
 
-    def save_to_gsheet(df: pd.DataFrame) -> None:
-        _SHEET.append_rows(df.astype(str).values.tolist())
+    @st.cache_resource
+    def _get_sheet() -> gspread.Worksheet:
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(GSHEET_KEY, _SCOPE)
+        return gspread.authorize(creds)\
+                      .open("Trivia_Responses")\
+                      .worksheet("Responses")
+
+    @st.cache_resource
+    def _upload_pool() -> ThreadPoolExecutor:
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gsheets")
+        atexit.register(pool.shutdown, wait=True)   # flush pending appends
+        return pool
+
+    # 429/503 mean the request was turned away; a 500/502/504 may already have
+    # written the rows, and append_rows is not idempotent, so those are not retried
+    _RETRY_STATUS = (429, 503)
+
+    def _append_rows(sheet: gspread.Worksheet, rows: List[List[str]], attempts: int = 5) -> None:
+        for attempt in range(attempts):   # exponential backoff on quota / unavailable
+            try:
+                sheet.append_rows(rows, value_input_option="RAW",
+                                  insert_data_option="INSERT_ROWS")
+                return
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code in _RETRY_STATUS and attempt < attempts - 1:
+                    time.sleep(0.5 * 2**attempt + random.random() * 0.1); continue
+                logging.exception("Google Sheets append failed"); return
+            except Exception:
+                logging.exception("Google Sheets append failed"); return
+
+    def save_to_gsheet(responses: Dict[str, list]) -> None:
+        rows = [[str(v) for v in row] for row in zip(*(responses[c] for c in COLUMNS))]
+        _upload_pool().submit(_append_rows, _get_sheet(), rows)   # off the script thread
 else:
-    def save_to_gsheet(_: pd.DataFrame) -> None: ...
+    def save_to_gsheet(_: Dict[str, list]) -> None: ...
 
 # ╭────────────────────────── stimulus dataclass ───────────────────────────╮
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Stimulus:
-    id: str; text: str; truth: bool; photo: str | None; show_photo: bool = False
-    @property
-    def has_photo(self): return self.photo and self.photo.endswith(".png")
-    @property
-    def image_path(self): return IMG_DIR/self.photo if self.has_photo else None
+    id: str; text: str; truth: bool; photo: str | None
+    image_path: Path | None = None   # set by load_stimuli for .png photos
 
-def load_stimuli() -> List[Stimulus]:
-    return [Stimulus(**d) for d in json.load(STIMULI.open())]
+@st.cache_data(max_entries=1)
+def _read_stimuli(mtime_ns: int) -> List[dict]:   # keyed on mtime → edits invalidate
+    return json_loads(STIMULI.read_bytes())
 
-def create_subset(pool: List[Stimulus]) -> List[Stimulus]:
-    true  = random.sample([s for s in pool if s.truth],  N_TRUE)
-    false = random.sample([s for s in pool if not s.truth], N_FALSE)
-    combo = true + false; random.shuffle(combo)
-
-    with_photo = [s for s in combo if s.has_photo]; random.shuffle(with_photo)
-    t=f=0
+def load_stimuli() -> List[Stimulus]:
+    return [Stimulus(**d, image_path=IMG_DIR/d["photo"]
+                     if (d.get("photo") or "").endswith(".png") else None)
+            for d in _read_stimuli(STIMULI.stat().st_mtime_ns)]
+
+@st.cache_resource(max_entries=1)   # shared, not copied: Stimulus is frozen
+def _pools(mtime_ns: int) -> tuple[tuple[Stimulus, ...], tuple[Stimulus, ...]]:
+    tr, fl = [], []
+    for s in load_stimuli(): (tr if s.truth else fl).append(s)
+    return tuple(tr), tuple(fl)
+
+def create_subset(rng: random.Random = random) -> tuple[List[Stimulus], frozenset[str]]:
+    true_pool, false_pool = _pools(STIMULI.stat().st_mtime_ns)
+    true  = rng.sample(true_pool,  N_TRUE)
+    false = rng.sample(false_pool, N_FALSE)
+    combo = true + false; rng.shuffle(combo)
+
+    with_photo = [s for s in combo if s.image_path]; rng.shuffle(with_photo)
+    photo_ids = set(); t=f=0
     for s in with_photo:
-        if s.truth and t < N_PHOTO_EACH: s.show_photo=True; t+=1
-        elif not s.truth and f < N_PHOTO_EACH: s.show_photo=True; f+=1
+        if s.truth and t < N_PHOTO_EACH: photo_ids.add(s.id); t+=1
+        elif not s.truth and f < N_PHOTO_EACH: photo_ids.add(s.id); f+=1
         if t==N_PHOTO_EACH and f==N_PHOTO_EACH: break
-    return combo
+    return combo, frozenset(photo_ids)
+
+def subset_for(pid: str) -> tuple[List[Stimulus], frozenset[str]]:
+    # seeded by pid → reproducible per participant
+    return create_subset(random.Random(pid))
 
 # ╭────────────────────────── Google Analytics (optional) ───────────────────╮
 if GA_ID:
@@ -90,10 +163,11 @@ BTN_KW  = {"use_container_width": VARIANT == "B", "type": "primary"}
 ss = st.session_state
 ss.setdefault("pid",         str(uuid.uuid4()))
 ss.setdefault("group",       random.choice(["Explain","Emotion"]))
-ss.setdefault("stimuli",     create_subset(load_stimuli()))
-ss.setdefault("responses",   [])
+if "stimuli" not in ss and not ss.get("done"):
+    ss.stimuli, ss.photo_ids = subset_for(ss.pid)   # trials + ids shown with a photo
+    ss.responses = {c: [] for c in COLUMNS}         # columnar
+    ss.t_start = None
 ss.setdefault("idx",         0)
-ss.setdefault("t_start",     None)
 
 # ╭────────────────────────── UI helpers ────────────────────────────────────╮
 def show_instructions():
@@ -107,53 +181,50 @@ def show_instructions():
 def run_trial(stim: Stimulus, i: int, total: int):
     st.subheader(f"Statement {i}/{total}")
     st.write(stim.text)
-    if stim.show_photo and stim.image_path.exists():
-        st.image(stim.image_path.read_bytes(), width=320)
+    show_photo = stim.id in ss.photo_ids
+    if show_photo and stim.image_path.exists():
+        st.markdown(f'<img src="{IMG_URL}/{stim.photo}" width="320">', unsafe_allow_html=True)
 
-    if ss.t_start is None: ss.t_start = time.time()
+    if ss.t_start is None: ss.t_start = time.monotonic()
     with st.form(f"f_{stim.id}"):
-        ans = st.radio("Is the statement…", ["True","False"], horizontal=True)
+        ans = st.radio("Is the statement…", [True, False], format_func=str, horizontal=True)
         txt = st.text_area("Explain:" if ss.group=="Explain" else "Feelings:", height=120)
         if st.form_submit_button("Submit & Next", **BTN_KW):
             if not txt.strip():
                 st.warning("Text box cannot be empty."); st.stop()
-            rt = round(time.time() - ss.t_start, 2); ss.t_start=None
-            ss.responses.append(dict(
+            rt = round(time.monotonic() - ss.t_start, 2); ss.t_start=None
+            row = dict(
                 timestamp=datetime.utcnow().isoformat(),
                 participant_id=ss.pid, variant=VARIANT, prompt_group=ss.group,
-                stimulus_id=stim.id, truth=stim.truth, answer=ans=="True",
-                correct=(ans=="True")==stim.truth, response_text=txt.strip(),
-                show_photo=stim.show_photo, rt=rt,
-                python=sys.version.split()[0], platform=platform.platform(),
-                streamlit=st.__version__,
-            ))
+                stimulus_id=stim.id, truth=stim.truth, answer=ans,
+                correct=ans==stim.truth, response_text=txt.strip(),
+                show_photo=show_photo, rt=rt,
+                python=_PY, platform=_PLATFORM, streamlit=_ST,
+            )
+            for k, v in row.items(): ss.responses[k].append(v)
+            append_csv(row)
             ss.idx += 1; st.rerun()
 
 def finish():
     st.balloons(); st.success("✔️ Responses saved — thank you!")
-    df = pd.DataFrame(ss.responses)
-    if CSV_FILE.exists():
-        df = pd.concat([pd.read_csv(CSV_FILE), df], ignore_index=True)
-    df.to_csv(CSV_FILE, index=False); save_to_gsheet(df)
+    save_to_gsheet(ss.responses)  # CSV rows were appended per trial
 
     st.markdown("### Quick stats (session)")
-    st.dataframe(df[["stimulus_id","correct","rt"]])
+    st.dataframe({c: ss.responses[c] for c in ("stimulus_id","correct","rt")})
 
-    st.markdown("### Debriefing")
-    st.markdown("""
-    Thank you for completing this short trivia survey!
-
-    This study investigates how visual cues (unrelated photos) and reasoning style
-    (**explanation** vs. **emotion**) influence people’s perception of truth.
+    show_debrief()
 
-    Your responses are recorded **anonymously** and will support research in
-    cognitive psychology and digital‑media literacy.
+    # all data is persisted — free the per-session buffers, keep a completion flag
+    for k in ("stimuli", "photo_ids", "responses", "t_start"): ss.pop(k, None)
+    ss.done = True
 
-    Questions? Email **aw3088@columbia.edu**.
-    """)
+def show_debrief():
+    st.markdown("### Debriefing")
+    st.markdown(_DEBRIEF_MD)
 
 # ╭────────────────────────── Main flow ─────────────────────────────────────╮
 st.title("🧠 Truth Perception Study" if VARIANT=="A" else "✨ Trivia & Feelings Survey")
 if ss.get("show_instructions", True): show_instructions()
+elif ss.get("done"):                     show_debrief()
 elif ss.idx < len(ss.stimuli):           run_trial(ss.stimuli[ss.idx], ss.idx+1, len(ss.stimuli))
 else:                                    finish()
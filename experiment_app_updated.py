@@ -1,64 +1,139 @@
 from __future__ import annotations
-import json, random, sys, time, uuid, platform
+import atexit, csv, json, logging, random, sys, time, uuid, platform
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
-import pandas as pd
 import streamlit as st
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+try:
+    from orjson import loads as json_loads   # faster parser when installed
+except ImportError:
+    json_loads = json.loads
 
 # ───────────────────────── paths / constants
 BASE_DIR          = Path(__file__).resolve().parent
 STIMULI_PATH      = BASE_DIR / "stimuli.json"
-IMAGES_DIR        = BASE_DIR / "images"
+IMAGES_DIR        = BASE_DIR / "static" / "images"
+IMAGES_URL        = "app/static/images"   # browser-cached static route
 LOG_DIR           = BASE_DIR / "logs"; LOG_DIR.mkdir(exist_ok=True)
 LOCAL_CSV         = LOG_DIR / "responses.csv"
 GOOGLE_SHEET_NAME = "Trivia_Responses"
 GOOGLE_SHEET_TAB  = "Responses"
 
 N_TRUE, N_FALSE, N_PHOTO_EACH = 8, 8, 4
+COLUMNS = ("timestamp", "participant_id", "variant", "prompt_group", "stimulus_id",
+           "truth", "answer", "correct", "response_text", "show_photo", "rt",
+           "py", "platform", "streamlit")
+
+# environment info logged with every response
+_PY, _PLATFORM, _ST = sys.version.split()[0], platform.platform(), st.__version__
+
+# static debriefing text
+_DEBRIEF_MD = """
+Thank you for completing this short trivia survey!
+
+This study is part of a research project investigating how visual cues (like unrelated photos) and different kinds of reasoning (**explanation** vs. **emotion**) affect people’s perception of truth.
+
+Some of the statements you saw were factually accurate, while others were not, and some were paired with images that were not directly related to the content. By analysing how people respond under different conditions, we hope to better understand how misinformation spreads online—especially when it is accompanied by persuasive visuals.
+
+Your responses have been recorded **anonymously** and will help support research in cognitive psychology and digital‑media literacy.
+
+If you have any questions, reach out to **aw3088@columbia.edu**.
+"""
+
+# ───────────────────────── CSV log helper
+def append_csv(row: dict) -> None:
+    header = not LOCAL_CSV.exists()
+    with LOCAL_CSV.open("a", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=COLUMNS, lineterminator="\n")
+        if header: w.writeheader()
+        w.writerow(row)
 
 # ───────────────────────── Google Sheets helper
-def save_to_google_sheets(df: pd.DataFrame) -> None:
+@st.cache_resource
+def _get_ws() -> gspread.Worksheet:
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(
+        st.secrets["GSPREAD_KEY"],
+        ["https://spreadsheets.google.com/feeds",
+         "https://www.googleapis.com/auth/drive"],
+    )
+    return gspread.authorize(creds) \
+                  .open(GOOGLE_SHEET_NAME) \
+                  .worksheet(GOOGLE_SHEET_TAB)
+
+@st.cache_resource
+def _upload_pool() -> ThreadPoolExecutor:
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gsheets")
+    atexit.register(pool.shutdown, wait=True)  # flush pending appends
+    return pool
+
+# 429/503 mean the request was turned away; a 500/502/504 may already have
+# written the rows, and append_rows is not idempotent, so those are not retried
+_RETRY_STATUS = (429, 503)
+
+def _append_rows(ws: gspread.Worksheet, rows: List[List[str]], attempts: int = 5) -> None:
+    # runs on the worker thread, where st.warning cannot render
+    for attempt in range(attempts):  # exponential backoff on quota / unavailable
+        try:
+            ws.append_rows(rows, value_input_option="RAW",
+                           insert_data_option="INSERT_ROWS")
+            return
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code in _RETRY_STATUS and attempt < attempts-1:
+                time.sleep(0.5 * 2**attempt + random.random()*0.1); continue
+            logging.exception("Google Sheets append failed"); return
+        except Exception:
+            logging.exception("Google Sheets append failed"); return
+
+def save_to_google_sheets(responses: Dict[str, list]) -> None:
     try:
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            st.secrets["GSPREAD_KEY"],
-            ["https://spreadsheets.google.com/feeds",
-             "https://www.googleapis.com/auth/drive"],
-        )
-        gspread.authorize(creds) \
-               .open(GOOGLE_SHEET_NAME) \
-               .worksheet(GOOGLE_SHEET_TAB) \
-               .append_rows(df.astype(str).values.tolist())
+        ws = _get_ws()
     except Exception as e:
-        st.warning(f"⚠️ Google‑Sheets write failed: {e}")
+        st.warning(f"⚠️ Google‑Sheets write failed: {e}"); return
+    rows = [[str(v) for v in row] for row in zip(*(responses[c] for c in COLUMNS))]
+    _upload_pool().submit(_append_rows, ws, rows)
 
 # ───────────────────────── stimulus model
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Stimulus:
-    id: str; text: str; truth: bool; photo: str | None; show_photo: bool = False
-    @property
-    def has_photo(self): return self.photo and self.photo.endswith(".png")
-    @property
-    def image_path(self): return IMAGES_DIR/self.photo if self.has_photo else None
+    id: str; text: str; truth: bool; photo: str | None
+    image_path: Path | None = None   # set by load_stimuli for .png photos
+
+@st.cache_data(max_entries=1)
+def _read_stimuli(mtime_ns: int) -> List[dict]:   # keyed on mtime → edits invalidate
+    return json_loads(STIMULI_PATH.read_bytes())
 
 def load_stimuli() -> List[Stimulus]:
-    return [Stimulus(**d) for d in json.load(STIMULI_PATH.open())]
-
-def create_subset(pool: List[Stimulus]) -> List[Stimulus]:
-    tr = random.sample([s for s in pool if s.truth],  N_TRUE)
-    fl = random.sample([s for s in pool if not s.truth], N_FALSE)
-    combo = tr + fl; random.shuffle(combo)
-    with_photo = [s for s in combo if s.has_photo]; random.shuffle(with_photo)
-    t=f=0
+    return [Stimulus(**d, image_path=IMAGES_DIR/d["photo"]
+                     if (d.get("photo") or "").endswith(".png") else None)
+            for d in _read_stimuli(STIMULI_PATH.stat().st_mtime_ns)]
+
+@st.cache_resource(max_entries=1)   # shared, not copied: Stimulus is frozen
+def _pools(mtime_ns: int) -> tuple[tuple[Stimulus, ...], tuple[Stimulus, ...]]:
+    tr, fl = [], []
+    for s in load_stimuli(): (tr if s.truth else fl).append(s)
+    return tuple(tr), tuple(fl)
+
+def create_subset(rng: random.Random = random) -> tuple[List[Stimulus], frozenset[str]]:
+    true_pool, false_pool = _pools(STIMULI_PATH.stat().st_mtime_ns)
+    tr = rng.sample(true_pool,  N_TRUE)
+    fl = rng.sample(false_pool, N_FALSE)
+    combo = tr + fl; rng.shuffle(combo)
+    with_photo = [s for s in combo if s.image_path]; rng.shuffle(with_photo)
+    photo_ids = set(); t=f=0
     for s in with_photo:
-        if s.truth and t<N_PHOTO_EACH: s.show_photo=True; t+=1
-        elif not s.truth and f<N_PHOTO_EACH: s.show_photo=True; f+=1
+        if s.truth and t<N_PHOTO_EACH: photo_ids.add(s.id); t+=1
+        elif not s.truth and f<N_PHOTO_EACH: photo_ids.add(s.id); f+=1
         if t==N_PHOTO_EACH and f==N_PHOTO_EACH: break
-    return combo
+    return combo, frozenset(photo_ids)
+
+def subset_for(participant_id: str) -> tuple[List[Stimulus], frozenset[str]]:
+    # seeded by participant id → reproducible per participant
+    return create_subset(random.Random(participant_id))
 
 # ───────────────────────── Streamlit init
 st.set_page_config("Truth Perception Study", "🤔", "centered")
@@ -88,10 +163,11 @@ if ga_id := st.secrets.get("GA_MEASUREMENT_ID"):
 ss = st.session_state
 ss.setdefault("participant_id", str(uuid.uuid4()))
 ss.setdefault("prompt_group", random.choice(["Explain", "Emotion"]))
-ss.setdefault("stimuli", create_subset(load_stimuli()))
-ss.setdefault("responses", [])
+if "stimuli" not in ss and not ss.get("done"):
+    ss.stimuli, ss.photo_ids = subset_for(ss.participant_id)  # trials + photo ids
+    ss.responses = {c: [] for c in COLUMNS}  # columnar
+    ss.start_time = None
 ss.setdefault("index", 0)
-ss.setdefault("start_time", None)
 
 # ───────────────────────── UI helpers
 def show_instructions():
@@ -108,52 +184,49 @@ def show_instructions():
 def run_trial(stim: Stimulus,i:int,total:int):
     st.subheader(f"Statement {i}/{total}")
     st.write(stim.text)
-    if stim.show_photo and stim.image_path and stim.image_path.exists():
-        st.image(stim.image_path.read_bytes(), width=320)
+    show_photo = stim.id in ss.photo_ids
+    if show_photo and stim.image_path and stim.image_path.exists():
+        st.markdown(f'<img src="{IMAGES_URL}/{stim.photo}" width="320">', unsafe_allow_html=True)
 
-    if ss.start_time is None: ss.start_time=time.time()
+    if ss.start_time is None: ss.start_time=time.monotonic()
     with st.form(f"f_{stim.id}"):
-        ans = st.radio("Is the statement…",["True","False"],horizontal=True)
+        ans = st.radio("Is the statement…",[True,False],format_func=str,horizontal=True)
         txt = st.text_area("Explain:" if ss.prompt_group=="Explain" else "Feelings:", height=120)
         if st.form_submit_button("Submit & Next", **BUTTON_OPTS):
             if not txt.strip(): st.warning("Text box cannot be empty."); st.stop()
-            rt = round(time.time()-ss.start_time, 2); ss.start_time=None
-            ss.responses.append(dict(
+            rt = round(time.monotonic()-ss.start_time, 2); ss.start_time=None
+            row = dict(
                 timestamp=datetime.utcnow().isoformat(),
                 participant_id=ss.participant_id, variant=VARIANT,
                 prompt_group=ss.prompt_group, stimulus_id=stim.id,
-                truth=stim.truth, answer=ans=="True",
-                correct=(ans=="True")==stim.truth, response_text=txt.strip(),
-                show_photo=stim.show_photo, rt=rt,
-                py=sys.version.split()[0], platform=platform.platform(),
-                streamlit=st.__version__
-            ))
+                truth=stim.truth, answer=ans,
+                correct=ans==stim.truth, response_text=txt.strip(),
+                show_photo=show_photo, rt=rt,
+                py=_PY, platform=_PLATFORM, streamlit=_ST
+            )
+            for k, v in row.items(): ss.responses[k].append(v)
+            append_csv(row)
             ss.index += 1; st.rerun()
 
 def finish():
     st.balloons(); st.success("✔️ Responses saved — thank you!")
-    df = pd.DataFrame(ss.responses)
-    if LOCAL_CSV.exists(): df = pd.concat([pd.read_csv(LOCAL_CSV), df], ignore_index=True)
-    df.to_csv(LOCAL_CSV, index=False)
-    save_to_google_sheets(df)
+    save_to_google_sheets(ss.responses)  # CSV rows were appended per trial
 
-    st.markdown("### Quick stats (session)"); st.dataframe(df[["stimulus_id","correct","rt"]])
+    st.markdown("### Quick stats (session)"); st.dataframe({c: ss.responses[c] for c in ("stimulus_id","correct","rt")})
 
-    st.markdown("### Debriefing")
-    st.markdown("""
-    Thank you for completing this short trivia survey!
+    show_debrief()
 
-    This study is part of a research project investigating how visual cues (like unrelated photos) and different kinds of reasoning (**explanation** vs. **emotion**) affect people’s perception of truth.
+    # everything is persisted → drop per-session buffers, keep a completion flag
+    for k in ("stimuli", "photo_ids", "responses", "start_time"): ss.pop(k, None)
+    ss.done = True
 
-    Some of the statements you saw were factually accurate, while others were not, and some were paired with images that were not directly related to the content. By analysing how people respond under different conditions, we hope to better understand how misinformation spreads online—especially when it is accompanied by persuasive visuals.
-
-    Your responses have been recorded **anonymously** and will help support research in cognitive psychology and digital‑media literacy.
-
-    If you have any questions, reach out to **aw3088@columbia.edu**.
-    """)
+def show_debrief():
+    st.markdown("### Debriefing")
+    st.markdown(_DEBRIEF_MD)
 
 # ───────────────────────── main flow
 st.title("🧠 Truth Perception Study" if VARIANT=="A" else "✨ Trivia & Feelings Survey")
 if ss.get("show_instructions", True): show_instructions()
+elif ss.get("done"): show_debrief()
 elif ss.index < len(ss.stimuli): run_trial(ss.stimuli[ss.index], ss.index+1, len(ss.stimuli))
 else: finish()
@@ -1,32 +1,57 @@
 from __future__ import annotations
 
+import atexit
+import csv
+import io
 import json
+import logging
+import os
+import platform
 import random
 import sys
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import List, Final
+from typing import Dict, List, Final
 
-import pandas as pd
 import streamlit as st
 
+try:
+    from orjson import loads as json_loads  # optional, faster parser
+except ImportError:
+    json_loads = json.loads
+
 # ══════════════════════════════════════ PATH & CONFIG ══════════════════════════════════════
 BASE:     Final = Path(__file__).parent
 STIM:     Final = BASE / "stimuli.json"
-IMGS:     Final = BASE / "images"
+IMGS:     Final = BASE / "static" / "images"
+IMGS_URL: Final = "app/static/images"  # browser-cached static route
 LOGS:     Final = BASE / "logs"; LOGS.mkdir(exist_ok=True)
 LOG_CSV:  Final = LOGS / "responses.csv"
 
 N_TRUE:       Final = 8
 N_FALSE:      Final = 8
 N_PHOTO_EACH: Final = 4
+COLUMNS:      Final = (
+    "timestamp", "pid", "variant", "prompt_group", "stim_id", "truth", "answer",
+    "correct", "response", "photo", "rt", "py", "os", "streamlit",
+)
+
+# environment info logged with every record
+_PY, _OS, _ST = sys.version.split()[0], platform.platform(), st.__version__
 
 SA_JSON = st.secrets.get("GSPREAD_KEY")   # optional Google Sheets
 GA_ID   = st.secrets.get("GA_ID", {}).get("value", "")  # optional GA4
 
+DEBRIEF_MD: Final = """
+This experiment examines how **visual cues** and **reasoning style**
+influence truth‑judgements. Your anonymous data aid research on digital
+misinformation. Questions? aw3088@columbia.edu
+"""
+
 # ══════════════════════════════════════ GOOGLE SHEETS ══════════════════════════════════════
 if SA_JSON:
     import gspread
@@ -36,48 +61,110 @@ if SA_JSON:
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/drive",
     )
-    _CREDS = ServiceAccountCredentials.from_json_keyfile_dict(SA_JSON, _SCOPE)
-    _WS    = gspread.authorize(_CREDS).open("Trivia_Responses").worksheet("Responses")
 
-    def to_sheet(df: pd.DataFrame) -> None:
-        _WS.append_rows(df.astype(str).values.tolist())
+    @st.cache_resource
+    def _ws() -> gspread.Worksheet:
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(SA_JSON, _SCOPE)
+        return gspread.authorize(creds).open("Trivia_Responses").worksheet("Responses")
+
+    @st.cache_resource
+    def _pool() -> ThreadPoolExecutor:
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gsheets")
+        atexit.register(pool.shutdown, wait=True)  # flush pending appends
+        return pool
+
+    # 429/503 mean the request was turned away; a 500/502/504 may already have
+    # written the rows, and append_rows is not idempotent, so those are not retried
+    _RETRY_STATUS = (429, 503)
+
+    def _append_rows(ws: gspread.Worksheet, rows: List[List[str]], attempts: int = 5) -> None:
+        for attempt in range(attempts):  # exponential backoff on quota / unavailable
+            try:
+                ws.append_rows(rows, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+                return
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code in _RETRY_STATUS and attempt < attempts - 1:
+                    time.sleep(0.5 * 2**attempt + random.random() * 0.1)
+                    continue
+                logging.exception("Google Sheets append failed")
+                return
+            except Exception:
+                logging.exception("Google Sheets append failed")
+                return
+
+    def save_to_gsheet(cols: Dict[str, list]) -> None:
+        rows = [[str(v) for v in row] for row in zip(*(cols[c] for c in COLUMNS))]
+        _pool().submit(_append_rows, _ws(), rows)
 else:
-    def to_sheet(_: pd.DataFrame) -> None: ...
+    def save_to_gsheet(_: Dict[str, list]) -> None: ...
 
 # ══════════════════════════════════════ MODEL ══════════════════════════════════════════════
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Stimulus:
     id: str
     text: str
     truth: bool
     photo: str | None
-    show_photo: bool = False
+    path: Path | None = None  # resolved by load_bank for .png photos
 
-    @property
-    def path(self) -> Path | None:
-        return IMGS / self.photo if self.photo and self.photo.endswith(".png") else None
 
-
-def load_bank() -> List[Stimulus]:
-    return [Stimulus(**d) for d in json.loads(STIM.read_text())]
+# keyed on stimuli.json's mtime so edits invalidate both caches; shared, not
+# copied, since Stimulus is frozen
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_bank(mtime_ns: int) -> tuple[Stimulus, ...]:
+    return tuple(
+        Stimulus(**d, path=IMGS / d["photo"] if (d.get("photo") or "").endswith(".png") else None)
+        for d in json_loads(STIM.read_bytes())
+    )
 
 
-def balanced_subset(bank: List[Stimulus]) -> List[Stimulus]:
-    true = random.sample([b for b in bank if b.truth], N_TRUE)
-    false = random.sample([b for b in bank if not b.truth], N_FALSE)
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _partitions(mtime_ns: int) -> tuple[tuple[Stimulus, ...], tuple[Stimulus, ...]]:
+    true_bank: list[Stimulus] = []
+    false_bank: list[Stimulus] = []
+    for s in load_bank(mtime_ns):
+        (true_bank if s.truth else false_bank).append(s)
+    return tuple(true_bank), tuple(false_bank)
+
+
+def append_log(record: dict) -> None:
+    # one O_APPEND write per record (header first if the file is new)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    fd = os.open(LOG_CSV, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        if os.fstat(fd).st_size == 0:
+            writer.writerow(COLUMNS)
+        writer.writerow([record.get(c) for c in COLUMNS])
+        os.write(fd, buf.getvalue().encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def balanced_subset(rng: random.Random = random) -> tuple[List[Stimulus], frozenset[str]]:
+    true_bank, false_bank = _partitions(STIM.stat().st_mtime_ns)
+    true = rng.sample(true_bank, N_TRUE)
+    false = rng.sample(false_bank, N_FALSE)
     trials = true + false
-    random.shuffle(trials)
+    rng.shuffle(trials)
 
-    with_ph = [s for s in trials if s.path]; random.shuffle(with_ph)
+    with_ph = [s for s in trials if s.path]; rng.shuffle(with_ph)
+    photo_ids: set[str] = set()
     t = f = 0
     for s in with_ph:
         if s.truth and t < N_PHOTO_EACH:
-            s.show_photo, t = True, t + 1
+            photo_ids.add(s.id); t += 1
         elif not s.truth and f < N_PHOTO_EACH:
-            s.show_photo, f = True, f + 1
+            photo_ids.add(s.id); f += 1
         if t == f == N_PHOTO_EACH:
             break
-    return trials
+    return trials, frozenset(photo_ids)
+
+
+def subset_for(pid: str) -> tuple[List[Stimulus], frozenset[str]]:
+    # seeded by pid → reproducible per participant
+    return balanced_subset(random.Random(pid))
 
 
 # ══════════════════════════════════════ STREAMLIT INIT ═════════════════════════════════════
@@ -103,10 +190,11 @@ if GA_ID:
 ss = st.session_state
 ss.setdefault("pid", str(uuid.uuid4()))
 ss.setdefault("group", random.choice(("Explain", "Emotion")))
-ss.setdefault("stimuli", balanced_subset(load_bank()))
+if "stimuli" not in ss and not ss.get("done"):
+    ss.stimuli, ss.photo_ids = subset_for(ss.pid)  # trials + ids shown with a photo
+    ss.log_cols = {c: [] for c in COLUMNS}  # column-major response log
+    ss.clock = 0.0
 ss.setdefault("idx", 0)
-ss.setdefault("log", [])
-ss.setdefault("clock", 0.0)
 
 # ══════════════════════════════════════ HELPERS ════════════════════════════════════════════
 def header() -> None:
@@ -127,14 +215,15 @@ def instruction_page() -> None:
 def trial_page(stim: Stimulus, idx: int, total: int) -> None:
     st.subheader(f"Statement {idx}/{total}")
     st.write(stim.text)
-    if stim.show_photo and stim.path and stim.path.exists():
-        st.image(stim.path.read_bytes(), width=320)
+    show_photo = stim.id in ss.photo_ids
+    if show_photo and stim.path and stim.path.exists():
+        st.markdown(f'<img src="{IMGS_URL}/{stim.photo}" width="320">', unsafe_allow_html=True)
 
     if not ss.clock:
-        ss.clock = time.time()
+        ss.clock = time.monotonic()
 
     with st.form(f"form_{stim.id}"):
-        answer = st.radio("Is it…", ("True", "False"), horizontal=True)
+        answer = st.radio("Is it…", (True, False), format_func=str, horizontal=True)
         prompt = "Explain:" if ss.group == "Explain" else "Feelings:"
         memo = st.text_area(prompt, height=120)
         ok = st.form_submit_button("Submit & Next", **BTN_CFG)
@@ -142,26 +231,27 @@ def trial_page(stim: Stimulus, idx: int, total: int) -> None:
     if ok:
         if not memo.strip():
             st.warning("Text cannot be empty."); st.stop()
-        rt = round(time.time() - ss.clock, 2)
+        rt = round(time.monotonic() - ss.clock, 2)
         ss.clock = 0.0
-        ss.log.append(
-            dict(
-                timestamp=datetime.utcnow().isoformat(),
-                pid=ss.pid,
-                variant=VARIANT,
-                prompt_group=ss.group,
-                stim_id=stim.id,
-                truth=stim.truth,
-                answer=answer == "True",
-                correct=(answer == "True") == stim.truth,
-                response=memo.strip(),
-                photo=stim.show_photo,
-                rt=rt,
-                py=sys.version.split()[0],
-                os=platform.platform(),
-                streamlit=st.__version__,
-            )
+        record = dict(
+            timestamp=datetime.utcnow().isoformat(),
+            pid=ss.pid,
+            variant=VARIANT,
+            prompt_group=ss.group,
+            stim_id=stim.id,
+            truth=stim.truth,
+            answer=answer,
+            correct=answer == stim.truth,
+            response=memo.strip(),
+            photo=show_photo,
+            rt=rt,
+            py=_PY,
+            os=_OS,
+            streamlit=_ST,
         )
+        for k, v in record.items():
+            ss.log_cols[k].append(v)
+        append_log(record)
         ss.idx += 1
         st.rerun()
 
@@ -169,27 +259,29 @@ def trial_page(stim: Stimulus, idx: int, total: int) -> None:
 def debrief_page() -> None:
     st.balloons()
     st.success("✔️ Responses saved — thank you!")
-    df = pd.DataFrame(ss.log)
-    df = pd.concat([pd.read_csv(LOG_CSV), df], ignore_index=True) if LOG_CSV.exists() else df
-    df.to_csv(LOG_CSV, index=False)
-    save_to_gsheet(df)
+    save_to_gsheet(ss.log_cols)  # CSV rows were appended per trial
+
+    st.markdown("### Session stats"); st.dataframe({c: ss.log_cols[c] for c in ("stim_id", "correct", "rt")})
+
+    debrief_text()
 
-    st.markdown("### Session stats"); st.dataframe(df[["stim_id", "correct", "rt"]])
+    # everything is persisted: free per-session buffers, keep a completion flag
+    for k in ("stimuli", "photo_ids", "log_cols", "clock"):
+        ss.pop(k, None)
+    ss.done = True
 
+
+def debrief_text() -> None:
     st.markdown("### Debriefing")
-    st.write(
-        """
-        This experiment examines how **visual cues** and **reasoning style**
-        influence truth‑judgements. Your anonymous data aid research on digital
-        misinformation. Questions? aw3088@columbia.edu
-        """
-    )
+    st.write(DEBRIEF_MD)
 
 
 # ══════════════════════════════════════ ROUTER ═════════════════════════════════════════════
 header()
 if ss.get("show_instruct", True):
     instruction_page()
+elif ss.get("done"):
+    debrief_text()
 elif ss.idx < len(ss.stimuli):
     trial_page(ss.stimuli[ss.idx], ss.idx + 1, len(ss.stimuli))
 else: